@@ -1,19 +1,108 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, g, before_render_template, template_rendered
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from collections import OrderedDict
 import sqlite3
 import hashlib
 from datetime import datetime, date
+import gzip
+import json
+import math
 import os
+import queue
+import re
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 
 DATABASE = os.environ.get('DATABASE', 'workout_tracker.db')
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 256))
+COMPRESS_MIN_SIZE = 500
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+STATS_FLUSH_INTERVAL = 5
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 1.0))
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_MAX_STREAM_SECONDS = int(os.environ.get('SSE_MAX_STREAM_SECONDS', 300))
+
+# Compiled templates are shared on disk so respawned gunicorn workers skip recompiling.
+# Cached bytecode is executed as-is, so the directory must only be writable by us.
+def template_bytecode_cache():
+    if not TEMPLATE_CACHE_DIR:
+        return FileSystemBytecodeCache()  # Jinja's private per-user temp directory
+    
+    os.makedirs(TEMPLATE_CACHE_DIR, mode=0o700, exist_ok=True)
+    st = os.stat(TEMPLATE_CACHE_DIR)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise RuntimeError(f'TEMPLATE_CACHE_DIR {TEMPLATE_CACHE_DIR} must be owned by this user and not group/world writable')
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': template_bytecode_cache(),
+    'trim_blocks': True,
+    'lstrip_blocks': True,
+}
 
 def get_db():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
+# Data versions live in SQLite so every worker sees the same invalidations
+def data_versions(conn, *scopes):
+    rows = conn.execute(
+        f'SELECT scope, version FROM data_versions WHERE scope IN ({", ".join("?" * len(scopes))})',
+        scopes
+    ).fetchall()
+    versions = {row['scope']: row['version'] for row in rows}
+    return tuple(versions.get(scope, 0) for scope in scopes)
+
+def bump_version(conn, scope):
+    conn.execute('''
+        INSERT INTO data_versions (scope, version) VALUES (?, 1)
+        ON CONFLICT (scope) DO UPDATE SET version = version + 1
+    ''', (scope,))
+
+# Rendered fragments are cached per worker, keyed by the data versions they were built from.
+# Workers run several threads, so the LRU bookkeeping happens under a lock.
+fragment_cache = OrderedDict()
+fragment_lock = threading.Lock()
+
+def get_fragment(key):
+    with fragment_lock:
+        fragment = fragment_cache.get(key)
+        if fragment is not None:
+            fragment_cache.move_to_end(key)
+    return fragment
+
+def render_fragment(key, template_name, **context):
+    fragment = Markup(render_template(template_name, **context))
+    with fragment_lock:
+        fragment_cache[key] = fragment
+        if len(fragment_cache) > FRAGMENT_CACHE_SIZE:
+            fragment_cache.popitem(last=False)
+    return fragment
+
+def exercise_options(conn, user_id):
+    key = ('exercise_options', user_id) + data_versions(conn, f'exercises:{user_id}')
+    options = get_fragment(key)
+    if options is None:
+        exercises = conn.execute('''
+            SELECT * FROM exercises
+            WHERE user_id = ? OR user_id IS NULL
+            ORDER BY name
+        ''', (user_id,)).fetchall()
+        options = render_fragment(key, '_exercise_options.html', exercises=exercises)
+    return options
+
 def init_db():
     # Ensure data directory exists
     db_dir = os.path.dirname(DATABASE)
@@ -112,11 +201,186 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (exercise_id) REFERENCES exercises (id)
             );
+
+            CREATE TABLE IF NOT EXISTS data_versions (
+                scope TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS route_stats (
+                endpoint TEXT PRIMARY KEY,
+                requests INTEGER NOT NULL,
+                render_ms REAL NOT NULL,
+                total_ms REAL NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                sent_bytes INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS workout_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                workout_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_workout_events_workout ON workout_events (workout_id, id);
         ''')
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+# Render timing and response size stats are buffered per worker and periodically
+# added to the route_stats table, so the report covers every worker
+pending_stats = {}
+stats_lock = threading.Lock()
+stats_flushed_at = time.monotonic()
+
+def record_route_stats(endpoint, render_ms, total_ms, raw_bytes, sent_bytes):
+    with stats_lock:
+        stats = pending_stats.setdefault(endpoint, [0, 0.0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += render_ms
+        stats[2] += total_ms
+        stats[3] += raw_bytes
+        stats[4] += sent_bytes
+
+def flush_route_stats(force=False):
+    global stats_flushed_at
+    with stats_lock:
+        if not pending_stats or (not force and time.monotonic() - stats_flushed_at < STATS_FLUSH_INTERVAL):
+            return
+        rows = [(endpoint, *stats) for endpoint, stats in pending_stats.items()]
+        pending_stats.clear()
+        stats_flushed_at = time.monotonic()
+    
+    with get_db() as conn:
+        conn.executemany('''
+            INSERT INTO route_stats (endpoint, requests, render_ms, total_ms, raw_bytes, sent_bytes)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (endpoint) DO UPDATE SET
+                requests = requests + excluded.requests,
+                render_ms = render_ms + excluded.render_ms,
+                total_ms = total_ms + excluded.total_ms,
+                raw_bytes = raw_bytes + excluded.raw_bytes,
+                sent_bytes = sent_bytes + excluded.sent_bytes
+        ''', rows)
+
+WHITESPACE_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+def minify_html(html):
+    # Newline rather than nothing keeps inline spacing and line comments in scripts intact
+    return WHITESPACE_BETWEEN_TAGS.sub('>\n<', html)
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    g.render_time = g.get('render_time', 0.0) + time.perf_counter() - g.render_started
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def optimize_response(response):
+    if request.endpoint in (None, 'static') or response.direct_passthrough or response.is_streamed:
+        return response
+
+    raw_bytes = sent_bytes = response.calculate_content_length() or 0
+    if (response.mimetype in COMPRESSIBLE_MIMETYPES and response.status_code == 200
+            and 'Content-Encoding' not in response.headers):
+        body = response.get_data()
+        if response.mimetype == 'text/html':
+            body = minify_html(body.decode('utf-8')).encode('utf-8')
+
+        if len(body) >= COMPRESS_MIN_SIZE:
+            if brotli and request.accept_encodings['br']:
+                body = brotli.compress(body, quality=5)
+                response.headers['Content-Encoding'] = 'br'
+            elif request.accept_encodings['gzip']:
+                body = gzip.compress(body, compresslevel=6)
+                response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+
+        response.set_data(body)
+        sent_bytes = len(body)
+
+    render_ms = g.get('render_time', 0.0) * 1000
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    response.headers['Server-Timing'] = f'render;dur={render_ms:.2f}, app;dur={total_ms:.2f}'
+
+    record_route_stats(request.endpoint, render_ms, total_ms, raw_bytes, sent_bytes)
+    flush_route_stats()
+    app.logger.debug('%s rendered in %.2fms (%.2fms total), %d -> %d bytes',
+                     request.endpoint, render_ms, total_ms, raw_bytes, sent_bytes)
+
+    return response
+
+# Live workout sync: set changes are stored as events so streams in any worker can replay them,
+# and subscribers in the publishing worker are woken immediately instead of waiting for a poll
+workout_subscribers = {}
+subscribers_lock = threading.Lock()
+
+def record_workout_event(conn, workout_id, event_type, payload):
+    conn.execute("DELETE FROM workout_events WHERE created_at < datetime('now', '-1 day')")
+    cursor = conn.execute('INSERT INTO workout_events (workout_id, event_type, payload) VALUES (?, ?, ?)',
+                          (workout_id, event_type, json.dumps(payload)))
+    return cursor.lastrowid
+
+def latest_workout_event_id(conn, workout_id):
+    return conn.execute('SELECT COALESCE(MAX(id), 0) FROM workout_events WHERE workout_id = ?',
+                        (workout_id,)).fetchone()[0]
+
+def publish_workout_event(workout_id):
+    with subscribers_lock:
+        subscribers = list(workout_subscribers.get(workout_id, ()))
+    for subscriber in subscribers:
+        subscriber.put_nowait(True)
+
+def stream_workout_events(workout_id, last_event_id):
+    subscriber = queue.Queue()
+    with subscribers_lock:
+        workout_subscribers.setdefault(workout_id, set()).add(subscriber)
+    
+    try:
+        yield 'retry: 3000\n\n'
+        # Each open stream holds a worker thread, so streams end periodically and
+        # EventSource reconnects with Last-Event-ID, freeing threads from closed tabs
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < SSE_MAX_STREAM_SECONDS:
+            try:
+                subscriber.get(timeout=SSE_POLL_INTERVAL)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+            except queue.Empty:
+                pass  # Poll anyway to pick up events published by other workers
+            
+            with get_db() as conn:
+                events = conn.execute('''
+                    SELECT id, event_type, payload FROM workout_events
+                    WHERE workout_id = ? AND id > ?
+                    ORDER BY id
+                ''', (workout_id, last_event_id)).fetchall()
+            
+            for event in events:
+                last_event_id = event['id']
+                yield f"id: {event['id']}\nevent: {event['event_type']}\ndata: {event['payload']}\n\n"
+            
+            if events:
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+    finally:
+        with subscribers_lock:
+            subscribers = workout_subscribers.get(workout_id)
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del workout_subscribers[workout_id]
+
 @app.route('/')
 def index():
     if 'user_id' not in session:
@@ -189,6 +453,7 @@ def add_exercise():
     with get_db() as conn:
         conn.execute('INSERT INTO exercises (name, muscle_group, improvement_direction, split_tracking, user_id) VALUES (?, ?, ?, ?, ?)',
                     (name, muscle_group, improvement_direction, split_tracking, session['user_id']))
+        bump_version(conn, f'exercises:{session["user_id"]}')
     
     return redirect(url_for('exercises'))
 
@@ -221,23 +486,56 @@ def workout_detail(workout_id):
             WHERE w.id = ? AND w.user_id = ?
         ''', (workout_id, session['user_id'])).fetchone()
         
-        program_exercises = conn.execute('''
-            SELECT e.id, e.name, pe.target_sets, pe.target_reps, e.split_tracking
-            FROM program_exercises pe
-            JOIN exercises e ON pe.exercise_id = e.id
-            WHERE pe.program_id = ?
-            ORDER BY pe.order_index
-        ''', (workout['program_id'],)).fetchall()
+        # Read before the sets so the live stream replays anything committed while rendering
+        last_event_id = latest_workout_event_id(conn, workout_id)
+        
+        # The set table only changes when the workout, its program or the user's exercises do
+        key = ('workout_sets', workout_id) + data_versions(
+            conn, f'workout:{workout_id}', f'program:{workout["program_id"]}', f'exercises:{session["user_id"]}'
+        )
+        program_block = get_fragment(key)
+        if program_block is None:
+            program_exercises = conn.execute('''
+                SELECT e.id, e.name, pe.target_sets, pe.target_reps, e.split_tracking
+                FROM program_exercises pe
+                JOIN exercises e ON pe.exercise_id = e.id
+                WHERE pe.program_id = ?
+                ORDER BY pe.order_index
+            ''', (workout['program_id'],)).fetchall()
+            
+            sets = conn.execute('''
+                SELECT ws.*, e.name as exercise_name
+                FROM workout_sets ws
+                JOIN exercises e ON ws.exercise_id = e.id
+                WHERE ws.workout_id = ?
+                ORDER BY e.name, ws.side, ws.set_number
+            ''', (workout_id,)).fetchall()
+            
+            program_block = render_fragment(key, '_workout_sets.html', program_exercises=program_exercises, sets=sets)
+    
+    return render_template('workout_detail.html', workout=workout, program_block=program_block,
+                           last_event_id=last_event_id)
+
+@app.route('/workout/<int:workout_id>/events')
+def workout_events(workout_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    with get_db() as conn:
+        workout = conn.execute('SELECT id FROM workouts WHERE id = ? AND user_id = ?',
+                               (workout_id, session['user_id'])).fetchone()
+        if not workout:
+            return jsonify({'error': 'Workout not found'}), 404
         
-        sets = conn.execute('''
-            SELECT ws.*, e.name as exercise_name
-            FROM workout_sets ws
-            JOIN exercises e ON ws.exercise_id = e.id
-            WHERE ws.workout_id = ?
-            ORDER BY e.name, ws.side, ws.set_number
-        ''', (workout_id,)).fetchall()
+        # Reconnecting clients resume where they left off, new ones from the event their page was rendered at
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+        if last_event_id is None:
+            last_event_id = request.args.get('after', type=int)
+        if last_event_id is None:
+            last_event_id = latest_workout_event_id(conn, workout_id)
     
-    return render_template('workout_detail.html', workout=workout, program_exercises=program_exercises, sets=sets)
+    return Response(stream_workout_events(workout_id, last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/new_workout', methods=['GET', 'POST'])
 def new_workout():
@@ -269,13 +567,25 @@ def add_set():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    workout_id = request.json['workout_id']
-    exercise_id = request.json['exercise_id']
-    weight = request.json['weight']
-    reps = request.json['reps']
-    side = request.json.get('side')
+    try:
+        workout_id = int(request.json['workout_id'])
+        exercise_id = int(request.json['exercise_id'])
+        weight = float(request.json['weight'])
+        reps = int(request.json['reps'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid set'}), 400
+    
+    side = request.json.get('side') or None
+    if not math.isfinite(weight) or side not in (None, 'left', 'right'):
+        return jsonify({'error': 'Invalid set'}), 400
     
     with get_db() as conn:
+        # Verify ownership
+        workout = conn.execute('SELECT id FROM workouts WHERE id = ? AND user_id = ?',
+                               (workout_id, session['user_id'])).fetchone()
+        if not workout:
+            return jsonify({'error': 'Workout not found'}), 404
+        
         # Get next set number for this side
         if side:
             set_number = conn.execute('''
@@ -290,10 +600,16 @@ def add_set():
                 WHERE workout_id = ? AND exercise_id = ? AND side IS NULL
             ''', (workout_id, exercise_id)).fetchone()[0]
         
-        conn.execute('''
+        cursor = conn.execute('''
             INSERT INTO workout_sets (workout_id, exercise_id, set_number, weight, reps, side)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (workout_id, exercise_id, set_number, weight, reps, side))
+        bump_version(conn, f'workout:{workout_id}')
+        
+        new_set = dict(conn.execute('''
+            SELECT id, exercise_id, set_number, weight, reps, side FROM workout_sets WHERE id = ?
+        ''', (cursor.lastrowid,)).fetchone())
+        record_workout_event(conn, workout_id, 'set_added', new_set)
         
         # Check for PR based on exercise improvement direction
         exercise = conn.execute('SELECT improvement_direction FROM exercises WHERE id = ?', (exercise_id,)).fetchone()
@@ -319,7 +635,8 @@ def add_set():
                 VALUES (?, ?, ?, ?, ?)
             ''', (session['user_id'], exercise_id, weight, reps, date.today()))
     
-    return jsonify({'success': True})
+    publish_workout_event(workout_id)
+    return jsonify({'success': True, 'set': new_set})
 
 @app.route('/programs')
 def programs():
@@ -374,13 +691,9 @@ def new_program():
         return redirect(url_for('programs'))
     
     with get_db() as conn:
-        exercises = conn.execute('''
-            SELECT * FROM exercises 
-            WHERE user_id = ? OR user_id IS NULL 
-            ORDER BY name
-        ''', (session['user_id'],)).fetchall()
+        options = exercise_options(conn, session['user_id'])
     
-    return render_template('new_program.html', exercises=exercises)
+    return render_template('new_program.html', exercise_options=options)
 
 @app.route('/prs')
 def personal_records():
@@ -478,6 +791,7 @@ def api_create_exercise():
             (name, muscle_group, improvement_direction, split_tracking, session['user_id'])
         )
         exercise_id = cursor.lastrowid
+        bump_version(conn, f'exercises:{session["user_id"]}')
     
     return jsonify({'success': True, 'exercise_id': exercise_id})
 
@@ -530,6 +844,27 @@ def api_exercise_history():
     
     return jsonify(data)
 
+@app.route('/api/render_stats')
+def api_render_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    flush_route_stats(force=True)
+    with get_db() as conn:
+        rows = conn.execute('SELECT * FROM route_stats ORDER BY endpoint').fetchall()
+    
+    return jsonify({
+        row['endpoint']: {
+            'requests': row['requests'],
+            'avg_render_ms': round(row['render_ms'] / row['requests'], 2),
+            'avg_total_ms': round(row['total_ms'] / row['requests'], 2),
+            'raw_bytes': row['raw_bytes'],
+            'sent_bytes': row['sent_bytes'],
+            'bytes_saved': row['raw_bytes'] - row['sent_bytes']
+        }
+        for row in rows
+    })
+
 # Edit and Delete Routes
 @app.route('/edit_exercise/<int:exercise_id>', methods=['POST'])
 def edit_exercise(exercise_id):
@@ -544,6 +879,7 @@ def edit_exercise(exercise_id):
     with get_db() as conn:
         conn.execute('UPDATE exercises SET name = ?, muscle_group = ?, improvement_direction = ?, split_tracking = ? WHERE id = ? AND user_id = ?',
                     (name, muscle_group, improvement_direction, split_tracking, exercise_id, session['user_id']))
+        bump_version(conn, f'exercises:{session["user_id"]}')
     
     return redirect(url_for('exercises'))
 
@@ -554,6 +890,7 @@ def delete_exercise(exercise_id):
     
     with get_db() as conn:
         conn.execute('DELETE FROM exercises WHERE id = ? AND user_id = ?', (exercise_id, session['user_id']))
+        bump_version(conn, f'exercises:{session["user_id"]}')
     
     return redirect(url_for('exercises'))
 
@@ -580,6 +917,7 @@ def edit_program(program_id):
                         (name, description, program_id))
             
             conn.execute('DELETE FROM program_exercises WHERE program_id = ?', (program_id,))
+            bump_version(conn, f'program:{program_id}')
             
             for i, exercise_id in enumerate(exercise_ids):
                 if exercise_id:
@@ -604,8 +942,11 @@ def edit_program(program_id):
             WHERE pe.program_id = ?
             ORDER BY pe.order_index
         ''', (program_id,)).fetchall()
+        
+        options = exercise_options(conn, session['user_id'])
     
-    return render_template('edit_program.html', program=program, exercises=exercises, program_exercises=program_exercises)
+    return render_template('edit_program.html', program=program, exercises=exercises, program_exercises=program_exercises,
+                           exercise_options=options)
 
 @app.route('/delete_program/<int:program_id>', methods=['POST'])
 def delete_program(program_id):
@@ -614,6 +955,7 @@ def delete_program(program_id):
     
     with get_db() as conn:
         conn.execute('DELETE FROM programs WHERE id = ? AND user_id = ?', (program_id, session['user_id']))
+        bump_version(conn, f'program:{program_id}')
     
     return redirect(url_for('programs'))
 
@@ -647,6 +989,7 @@ def delete_workout(workout_id):
     
     with get_db() as conn:
         conn.execute('DELETE FROM workouts WHERE id = ? AND user_id = ?', (workout_id, session['user_id']))
+        bump_version(conn, f'workout:{workout_id}')
     
     return redirect(url_for('workouts'))
 
@@ -665,9 +1008,14 @@ def delete_set(set_id):
         
         if set_data:
             conn.execute('DELETE FROM workout_sets WHERE id = ?', (set_id,))
-            return jsonify({'success': True})
+            bump_version(conn, f'workout:{set_data["workout_id"]}')
+            record_workout_event(conn, set_data['workout_id'], 'set_deleted', {'id': set_id})
     
-    return jsonify({'error': 'Set not found'}), 404
+    if not set_data:
+        return jsonify({'error': 'Set not found'}), 404
+    
+    publish_workout_event(set_data['workout_id'])
+    return jsonify({'success': True})
 
 # Initialize database on startup
 init_db()
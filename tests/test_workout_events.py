@@ -0,0 +1,157 @@
+"""Live workout sync: two clients stream a workout from separate server processes.
+
+Both processes share one SQLite database, like two gunicorn workers. The client
+on the process that handles the POST is woken by the in-process pub/sub. The
+client on the other process only sees the change when it next polls the table.
+"""
+import http.cookiejar
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+POLL_INTERVAL = 2.0
+SAME_WORKER_LATENCY = 0.5  # Well under the poll interval, so only the wake-up path can meet it
+CROSS_WORKER_LATENCY = POLL_INTERVAL + 0.5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, database):
+    env = dict(os.environ, DATABASE=database, SECRET_KEY='test-secret', SSE_POLL_INTERVAL=str(POLL_INTERVAL))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+class Client:
+    def __init__(self, base_url, cookies=None):
+        self.base_url = base_url
+        self.cookies = cookies if cookies is not None else http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def form(self, path, data):
+        return self.opener.open(self.base_url + path, urllib.parse.urlencode(data, doseq=True).encode())
+
+    def post_json(self, path, data=None):
+        request = urllib.request.Request(self.base_url + path, json.dumps(data or {}).encode(),
+                                         {'Content-Type': 'application/json'})
+        try:
+            response = self.opener.open(request)
+        except urllib.error.HTTPError as error:
+            return error.code, json.loads(error.read())
+        return response.status, json.loads(response.read())
+
+    def login(self, username):
+        self.form('/register', {'username': username, 'password': 'secret'})
+        self.form('/login', {'username': username, 'password': 'secret'})
+
+
+class EventStream:
+    def __init__(self, client, workout_id):
+        self.events = queue.Queue()
+        self.response = client.opener.open(f'{client.base_url}/workout/{workout_id}/events', timeout=30)
+        assert self.response.readline().startswith(b'retry:')  # Subscribed before anything is published
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        event_type = None
+        for line in self.response:
+            line = line.decode().rstrip('\n')
+            if line.startswith('event: '):
+                event_type = line[len('event: '):]
+            elif line.startswith('data: '):
+                self.events.put((time.monotonic(), event_type, json.loads(line[len('data: '):])))
+
+    def next_event(self):
+        return self.events.get(timeout=CROSS_WORKER_LATENCY * 2)
+
+
+@pytest.fixture(scope='module')
+def servers(tmp_path_factory):
+    database = str(tmp_path_factory.mktemp('liftstash') / 'workout_tracker.db')
+    # Started one after the other so init_db doesn't race on the schema
+    processes = [start_server(free_port(), database) for _ in range(2)]
+    yield [f'http://127.0.0.1:{process.args[-1]}' for process in processes]
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture(scope='module')
+def workout(servers):
+    owner = Client(servers[0])
+    owner.login('lifter')
+    owner.form('/add_exercise', {'name': 'Squat', 'muscle_group': 'Legs'})
+    owner.form('/new_program', {'name': 'Legs', 'exercise_ids': ['1'], 'target_sets': ['3'], 'target_reps': ['5']})
+    response = owner.form('/new_workout', {'program_id': '1', 'date': '2024-01-01'})
+    return owner, int(response.url.rsplit('/', 1)[-1])
+
+
+def test_set_changes_reach_both_clients(servers, workout):
+    owner, workout_id = workout
+    same_worker = EventStream(owner, workout_id)
+    # Same user on a second device, served by the other process
+    other_worker = EventStream(Client(servers[1], owner.cookies), workout_id)
+
+    sent_at = time.monotonic()
+    status, body = owner.post_json('/add_set', {'workout_id': workout_id, 'exercise_id': 1, 'weight': 100, 'reps': 5})
+    assert status == 200
+    new_set = body['set']
+
+    for stream, bound in ((same_worker, SAME_WORKER_LATENCY), (other_worker, CROSS_WORKER_LATENCY)):
+        received_at, event_type, payload = stream.next_event()
+        assert event_type == 'set_added'
+        assert payload == new_set
+        assert received_at - sent_at < bound
+
+    sent_at = time.monotonic()
+    status, _ = owner.post_json(f'/delete_set/{new_set["id"]}')
+    assert status == 200
+
+    for stream, bound in ((same_worker, SAME_WORKER_LATENCY), (other_worker, CROSS_WORKER_LATENCY)):
+        received_at, event_type, payload = stream.next_event()
+        assert event_type == 'set_deleted'
+        assert payload == {'id': new_set['id']}
+        assert received_at - sent_at < bound
+
+
+def test_add_set_rejects_other_users_workout(servers, workout):
+    owner, workout_id = workout
+    stream = EventStream(owner, workout_id)
+    intruder = Client(servers[0])
+    intruder.login('intruder')
+
+    status, _ = intruder.post_json('/add_set', {'workout_id': workout_id, 'exercise_id': 1, 'weight': 100, 'reps': 5})
+    assert status == 404
+    status, _ = owner.post_json('/add_set', {'workout_id': workout_id, 'exercise_id': 1, 'weight': 100,
+                                             'reps': '<img src=x onerror=alert(1)>'})
+    assert status == 400
+
+    with pytest.raises(queue.Empty):
+        stream.events.get(timeout=CROSS_WORKER_LATENCY)